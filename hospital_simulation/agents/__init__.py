@@ -12,12 +12,13 @@ from .base_agent import BaseAgent
 from .front_desk_agent import FrontDeskAgent
 from .physician_agent import PhysicianAgent
 from .radiologist_agent import RadiologistAgent
-from .agent_graph import HospitalGraph
+from .agent_graph import HospitalGraph, get_graph
 
 __all__ = [
     'BaseAgent',
     'FrontDeskAgent',
     'PhysicianAgent',
     'RadiologistAgent',
-    'HospitalGraph'
+    'HospitalGraph',
+    'get_graph'
 ] 
\ No newline at end of file
@@ -1,41 +1,77 @@
-from typing import Dict, Any, TypedDict, Annotated, List, Optional
-from langgraph.graph import StateGraph, END
-from pydantic import BaseModel, Field
+import asyncio
+import logging
+import re
+import threading
+import uuid
+from concurrent.futures import Future
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from pathlib import Path
+from typing import AsyncIterator, Dict, Any, TypedDict, List, Optional, Tuple
+import aiosqlite
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+from langgraph.graph import StateGraph, START, END
+from langgraph.types import Send
+from hospital_simulation.agents.base_agent import BaseAgent, LogEntry, format_log_entries
 from hospital_simulation.agents.front_desk_agent import FrontDeskAgent
 from hospital_simulation.agents.physician_agent import PhysicianAgent
 from hospital_simulation.agents.radiologist_agent import RadiologistAgent
 
-class Assessment(BaseModel):
-    """Base model for agent assessments"""
-    response: str = Field(default="")
+# Terms in a physician assessment that call for a radiology review, matched in one pass
+_IMAGING_RE = re.compile(r"\b(?:imaging|x-rays?|mri|ct scans?)\b", re.IGNORECASE)
 
-class PatientState(BaseModel):
-    """Type definition for patient state in the workflow using Pydantic."""
-    patient_info: Dict[str, Any] = Field(default_factory=dict)
-    complaint: str = Field(default="")
-    medical_records: str = Field(default="")
-    
-    # Agent assessments with proper initialization
-    front_desk_assessment: Optional[Assessment] = Field(default_factory=Assessment)
-    physician_assessment: Optional[Assessment] = Field(default_factory=Assessment)
-    radiology_report: Optional[Assessment] = Field(default_factory=Assessment)
+logger = logging.getLogger(__name__)
+
+class PatientState(TypedDict, total=False):
+    """Type definition for patient state in the workflow.
+
+    A plain dict, so node updates are merged without model validation.
+    """
+    patient_info: Dict[str, Any]
+    complaint: str
+    medical_records: str
     
-    # Agent logs with proper initialization
-    front_desk_logs: List[str] = Field(default_factory=list)
-    physician_logs: List[str] = Field(default_factory=list)
-    radiologist_logs: List[str] = Field(default_factory=list)
+    # Agent assessments
+    front_desk_assessment: str
+    physician_assessment: str
+    radiology_report: str
+    needs_imaging: bool
     
-    class Config:
-        arbitrary_types_allowed = True
+    # Agent logs
+    front_desk_logs: List[LogEntry]
+    physician_logs: List[LogEntry]
+    radiologist_logs: List[LogEntry]
+
+# Groq model per agent. Front desk triage is a light task, so it uses a small,
+# fast model; diagnosis and radiology stay on the 70B model.
+DEFAULT_MODELS = {
+    "front_desk": "llama-3.1-8b-instant",
+    "physician": "llama-3.3-70b-versatile",
+    "radiologist": "llama-3.3-70b-versatile"
+}
 
 class HospitalGraph:
-    def __init__(self):
-        self.front_desk = FrontDeskAgent()
-        self.physician = PhysicianAgent()
-        self.radiologist = RadiologistAgent()
-        self.workflow = self._create_workflow()
+    def __init__(self,
+                 model_names: Optional[Dict[str, str]] = None,
+                 checkpoint_db: str = "./data/hospital_state.db"):
+        """``model_names`` overrides DEFAULT_MODELS per agent (front_desk, physician, radiologist)."""
+        model_names = {**DEFAULT_MODELS, **(model_names or {})}
+        # Agents on the same model share one client and its connection pool
+        llms = {name: BaseAgent.create_llm(name) for name in set(model_names.values())}
+        self.front_desk = FrontDeskAgent(model_names["front_desk"], llm=llms[model_names["front_desk"]])
+        self.physician = PhysicianAgent(model_names["physician"], llm=llms[model_names["physician"]])
+        self.radiologist = RadiologistAgent(model_names["radiologist"], llm=llms[model_names["radiologist"]])
+        self.checkpoint_db = Path(checkpoint_db)
+        # Agents' async HTTP clients are bound to the loop they first run on, so
+        # every caller's work is scheduled onto one loop running in its own thread.
+        self._loop = asyncio.new_event_loop()
+        # Checkpoint threads with a run in progress; only touched on self._loop
+        self._active_threads = set()
+        threading.Thread(target=self._loop.run_forever, name="hospital-graph-loop", daemon=True).start()
+        # The checkpointer's connection is opened on that loop, which it stays bound to
+        self.workflow = asyncio.run_coroutine_threadsafe(self._create_workflow(), self._loop).result()
 
-    def _create_workflow(self) -> StateGraph:
+    async def _create_workflow(self) -> StateGraph:
         """Create the workflow graph connecting all agents."""
         # Create a new graph with Pydantic model
         workflow = StateGraph(PatientState)
@@ -45,8 +81,10 @@ class HospitalGraph:
         workflow.add_node("physician", self._physician_node)
         workflow.add_node("radiologist", self._radiologist_node)
 
-        # Define the edges
-        workflow.add_edge("front_desk", "physician")
+        # Define the edges: front desk and physician are independent, so the
+        # dispatcher fans out to both in the same step
+        workflow.add_conditional_edges(START, self._dispatch, ["front_desk", "physician"])
+        workflow.add_edge("front_desk", END)
         workflow.add_conditional_edges(
             "physician",
             self._needs_imaging,
@@ -57,183 +95,297 @@ class HospitalGraph:
         )
         workflow.add_edge("radiologist", END)
 
-        # Set the entry point
-        workflow.set_entry_point("front_desk")
+        # Persist state after every node so an interrupted run resumes at the
+        # node that failed instead of repeating completed LLM calls
+        self.checkpoint_db.parent.mkdir(parents=True, exist_ok=True)
+        checkpointer = AsyncSqliteSaver(await aiosqlite.connect(str(self.checkpoint_db)))
         
-        return workflow.compile()
+        return workflow.compile(checkpointer=checkpointer)
 
-    def _front_desk_node(self, state: PatientState) -> Dict[str, PatientState]:
+    def _dispatch(self, state: PatientState) -> List[Send]:
+        """Send the patient to front desk and physician concurrently."""
+        return [Send("front_desk", state), Send("physician", state)]
+
+    async def _front_desk_node(self, state: PatientState) -> Dict[str, Any]:
         """Process patient at front desk."""
         try:
-            result = self.front_desk.process_patient(
-                state.patient_info,
-                state.complaint
+            result = await self.front_desk.process_patient(
+                state["patient_info"],
+                state["complaint"]
             )
-            # Create a new Assessment with the response
-            assessment = Assessment(response=result.get("response", ""))
-            # Update state with the new assessment and logs
-            state.front_desk_assessment = assessment
-            state.front_desk_logs = result.get("logs", [])
-            print(f"Front desk logs: {len(state.front_desk_logs)} entries")
-            print(f"Front desk response length: {len(state.front_desk_assessment.response)}")
-            return {"front_desk": state}
+            assessment = result.get("response", "")
+            logs = result.get("logs", [])
+            logger.debug("Front desk logs: %d entries, response length: %d", len(logs), len(assessment))
+            # Only return the fields this node owns so parallel branches don't clash
+            return {"front_desk_assessment": assessment, "front_desk_logs": logs}
         except Exception as e:
-            print(f"Error in front desk node: {e}")
-            state.front_desk_logs = [f"Error in front desk processing: {str(e)}"]
-            return {"front_desk": state}
+            logger.error("Error in front desk node: %s", e)
+            # Propagate so the checkpoint keeps this node pending and a rerun resumes here
+            raise
 
-    def _physician_node(self, state: PatientState) -> Dict[str, PatientState]:
+    async def _physician_node(self, state: PatientState) -> Dict[str, Any]:
         """Process patient with physician."""
         try:
-            result = self.physician.examine_patient(
-                state.patient_info,
-                state.complaint,
-                state.medical_records
+            result = await self.physician.examine_patient(
+                state["patient_info"],
+                state["complaint"],
+                state.get("medical_records", "")
             )
-            # Create a new Assessment with the response
-            assessment = Assessment(response=result.get("response", ""))
-            # Update state with the new assessment and logs
-            state.physician_assessment = assessment
-            state.physician_logs = result.get("logs", [])
-            print(f"Physician logs: {len(state.physician_logs)} entries")
-            print(f"Physician response length: {len(state.physician_assessment.response)}")
-            return {"physician": state}
+            assessment = result.get("response", "")
+            logs = result.get("logs", [])
+            logger.debug("Physician logs: %d entries, response length: %d", len(logs), len(assessment))
+            return {
+                "physician_assessment": assessment,
+                "physician_logs": logs,
+                # Decided on the finished text; streamed chunks can split or extend a term
+                "needs_imaging": _IMAGING_RE.search(assessment) is not None
+            }
         except Exception as e:
-            print(f"Error in physician node: {e}")
-            state.physician_logs = [f"Error in physician processing: {str(e)}"]
-            return {"physician": state}
+            logger.error("Error in physician node: %s", e)
+            # Propagate so the checkpoint keeps this node pending and a rerun resumes here
+            raise
 
-    def _radiologist_node(self, state: PatientState) -> Dict[str, PatientState]:
+    async def _radiologist_node(self, state: PatientState) -> Dict[str, Any]:
         """Process patient with radiologist if imaging is needed."""
         try:
-            result = self.radiologist.analyze_imaging(
-                state.patient_info,
-                state.physician_assessment.response,
-                state.medical_records
+            result = await self.radiologist.analyze_imaging(
+                state["patient_info"],
+                state.get("physician_assessment", ""),
+                state.get("medical_records", "")
             )
-            # Create a new Assessment with the response
-            assessment = Assessment(response=result.get("response", ""))
-            # Update state with the new assessment and logs
-            state.radiology_report = assessment
-            state.radiologist_logs = result.get("logs", [])
-            print(f"Radiologist logs: {len(state.radiologist_logs)} entries")
-            print(f"Radiologist response length: {len(state.radiology_report.response)}")
-            return {"radiologist": state}
+            assessment = result.get("response", "")
+            logs = result.get("logs", [])
+            logger.debug("Radiologist logs: %d entries, response length: %d", len(logs), len(assessment))
+            return {"radiology_report": assessment, "radiologist_logs": logs}
         except Exception as e:
-            print(f"Error in radiologist node: {e}")
-            state.radiologist_logs = [f"Error in radiologist processing: {str(e)}"]
-            return {"radiologist": state}
+            logger.error("Error in radiologist node: %s", e)
+            # Propagate so the checkpoint keeps this node pending and a rerun resumes here
+            raise
 
     def _needs_imaging(self, state: PatientState) -> bool:
         """Determine if patient needs imaging based on physician assessment."""
-        return "imaging" in state.physician_assessment.response.lower()
+        return state.get("needs_imaging", False)
+
+    @staticmethod
+    def _format_assessment(responses: Dict[str, Any]) -> str:
+        """Format the agents' assessments as a markdown report."""
+        parts = [
+            "\n# Medical Assessment Report\n",
+            "\n## 1. Front Desk Assessment\n", responses["front_desk_assessment"], "\n",
+            "\n## 2. Physician Assessment\n", responses["physician_assessment"], "\n"
+        ]
+        if responses["radiology_report"]:
+            parts += ["\n## 3. Radiology Report\n", responses["radiology_report"], "\n"]
+        return "".join(parts)
+
+    @staticmethod
+    def _format_logs(responses: Dict[str, Any]) -> str:
+        """Format the agents' logs as markdown code blocks."""
+        sections = [
+            ("Front Desk Logs", responses["front_desk_logs"]),
+            ("Physician Logs", responses["physician_logs"])
+        ]
+        if responses["radiologist_logs"]:
+            sections.append(("Radiologist Logs", responses["radiologist_logs"]))
+        
+        parts = ["\n# Processing Logs\n"]
+        for title, logs in sections:
+            parts += ["\n## ", title, "\n```\n", "\n".join(logs), "\n```\n"]
+        return "".join(parts)
 
     def process_patient(self, 
                        patient_info: Dict[str, Any], 
                        complaint: str,
                        medical_records: str = "") -> Dict[str, Any]:
         """Process a patient through the hospital workflow."""
-        try:
-            # Initialize responses and logs dictionary
-            responses = {
-                "front_desk_assessment": "",
-                "physician_assessment": "",
-                "radiology_report": "",
-                "front_desk_logs": [],
-                "physician_logs": [],
-                "radiologist_logs": []
-            }
-            
-            # Process through front desk
-            print("\n=== Front Desk Processing ===")
-            front_desk_result = self.front_desk.process_patient(
-                patient_info,
-                complaint
-            )
-            responses["front_desk_assessment"] = front_desk_result.get("response", "")
-            responses["front_desk_logs"] = front_desk_result.get("logs", [])
-            
-            # Process through physician
-            print("\n=== Physician Examination ===")
-            physician_result = self.physician.examine_patient(
-                patient_info,
-                complaint,
-                medical_records
-            )
-            responses["physician_assessment"] = physician_result.get("response", "")
-            responses["physician_logs"] = physician_result.get("logs", [])
-            
-            # Check if imaging is needed based on physician's response
-            if "imaging" in physician_result.get("response", "").lower():
-                print("\n=== Radiology Analysis ===")
-                radiology_result = self.radiologist.analyze_imaging(
-                    patient_info,
-                    physician_result.get("response", ""),
-                    medical_records
-                )
-                responses["radiology_report"] = radiology_result.get("response", "")
-                responses["radiologist_logs"] = radiology_result.get("logs", [])
-            
-            # Format medical assessment in markdown
-            medical_assessment = f"""
-# Medical Assessment Report
+        return self.submit_patient(patient_info, complaint, medical_records).result()
 
-## 1. Front Desk Assessment
-{responses['front_desk_assessment']}
+    def submit_patient(self,
+                       patient_info: Dict[str, Any],
+                       complaint: str,
+                       medical_records: str = "") -> Future:
+        """Schedule a patient on the workflow's event loop without blocking.
 
-## 2. Physician Assessment
-{responses['physician_assessment']}
-"""
-            if responses["radiology_report"]:
-                medical_assessment += f"""
-## 3. Radiology Report
-{responses['radiology_report']}
-"""
+        Safe to call from any thread; callers on another event loop can await
+        the result with ``asyncio.wrap_future``.
+        """
+        return asyncio.run_coroutine_threadsafe(
+            self.aprocess_patient(patient_info, complaint, medical_records), self._loop
+        )
 
-            # Format logs in markdown
-            processing_logs = f"""
-# Processing Logs
+    def process_patients(self,
+                         patients: List[Dict[str, Any]],
+                         max_concurrency: int = 4) -> List[Any]:
+        """Process a batch of patients through the hospital workflow."""
+        return asyncio.run_coroutine_threadsafe(
+            self.aprocess_patients(patients, max_concurrency), self._loop
+        ).result()
 
-## Front Desk Logs
-```
-{chr(10).join(responses['front_desk_logs'])}
-```
+    async def aprocess_patients(self,
+                                patients: List[Dict[str, Any]],
+                                max_concurrency: int = 4) -> List[Any]:
+        """Process a batch of patients concurrently.
 
-## Physician Logs
-```
-{chr(10).join(responses['physician_logs'])}
-```
-"""
-            if responses["radiologist_logs"]:
-                processing_logs += f"""
-## Radiologist Logs
-```
-{chr(10).join(responses['radiologist_logs'])}
-```
-"""
-            
-            # Print debug information
-            print("\nCollected Responses:")
-            print(f"Front Desk: {len(responses['front_desk_assessment'])} chars")
-            print(f"Physician: {len(responses['physician_assessment'])} chars")
-            print(f"Radiology: {len(responses['radiology_report'])} chars")
-            
-            # Return formatted responses
-            return {
-                "front_desk_assessment": responses["front_desk_assessment"],
-                "physician_assessment": responses["physician_assessment"],
-                "radiology_report": responses["radiology_report"],
-                "front_desk_logs": responses["front_desk_logs"],
-                "physician_logs": responses["physician_logs"],
-                "radiologist_logs": responses["radiologist_logs"],
-                "formatted_assessment": medical_assessment,
-                "formatted_logs": processing_logs
-            }
+        Each patient is a dict of ``aprocess_patient`` keyword arguments. At most
+        ``max_concurrency`` patients are in flight to stay within Groq rate
+        limits. Results come back in input order, with the exception in place
+        of any patient that failed.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def process_one(patient: Dict[str, Any]) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.aprocess_patient(**patient)
+
+        return await asyncio.gather(
+            *(process_one(patient) for patient in patients),
+            return_exceptions=True
+        )
+
+    async def aprocess_patient(self,
+                               patient_info: Dict[str, Any],
+                               complaint: str,
+                               medical_records: str = "") -> Dict[str, Any]:
+        """Process a patient through the hospital workflow asynchronously."""
+        try:
+            async with self._patient_run(patient_info, complaint, medical_records) as (config, inputs):
+                # Run the compiled workflow; it fans out to front desk and physician
+                # and routes to radiology when the assessment calls for imaging
+                final_state = await self.workflow.ainvoke(inputs, config)
+            return self._build_result(final_state)
             
         except Exception as e:
-            print(f"\nError processing patient: {e}")
-            error_msg = f"Error in processing: {str(e)}"
-            error_assessment = f"""
+            return self._error_result(e)
+
+    async def astream_patient(self,
+                              patient_info: Dict[str, Any],
+                              complaint: str,
+                              medical_records: str = "") -> AsyncIterator[Dict[str, Any]]:
+        """Yield the patient's results so far each time workflow agents finish.
+
+        Runs on the graph's own event loop; use ``stream_patient`` from others.
+        """
+        try:
+            async with self._patient_run(patient_info, complaint, medical_records) as (config, inputs):
+                async for state in self.workflow.astream(inputs, config, stream_mode="values"):
+                    yield self._build_result(state)
+        except Exception as e:
+            yield self._error_result(e)
+
+    async def stream_patient(self,
+                             patient_info: Dict[str, Any],
+                             complaint: str,
+                             medical_records: str = "") -> AsyncIterator[Dict[str, Any]]:
+        """Stream ``astream_patient`` results into the caller's event loop."""
+        loop = asyncio.get_running_loop()
+        updates: asyncio.Queue = asyncio.Queue()
+        finished = object()
+
+        async def produce():
+            try:
+                async for result in self.astream_patient(patient_info, complaint, medical_records):
+                    loop.call_soon_threadsafe(updates.put_nowait, result)
+            finally:
+                loop.call_soon_threadsafe(updates.put_nowait, finished)
+
+        future = asyncio.run_coroutine_threadsafe(produce(), self._loop)
+        try:
+            while (result := await updates.get()) is not finished:
+                yield result
+        finally:
+            future.cancel()
+
+    @asynccontextmanager
+    async def _patient_run(self,
+                           patient_info: Dict[str, Any],
+                           complaint: str,
+                           medical_records: str) -> AsyncIterator[Tuple[Dict[str, Any], Optional[PatientState]]]:
+        """Claim a checkpoint thread for one run and yield its config and inputs.
+
+        Each patient gets its own thread, so an interrupted run can be resumed.
+        A run started while another for the same patient is in progress gets a
+        throwaway thread instead of sharing (and interleaving writes with) it.
+        Checkpoints are deleted once a run completes; failed or interrupted runs keep them.
+        """
+        patient_thread = str(patient_info["patient_id"])
+        thread_id = patient_thread
+        if thread_id in self._active_threads:
+            thread_id = f"{patient_thread}:{uuid.uuid4().hex}"
+        self._active_threads.add(thread_id)
+        try:
+            config, inputs = await self._prepare_run(thread_id, patient_info, complaint, medical_records)
+            yield config, inputs
+            if thread_id == patient_thread and not (await self.workflow.aget_state(config)).next:
+                await self.workflow.checkpointer.adelete_thread(thread_id)
+        finally:
+            self._active_threads.discard(thread_id)
+            if thread_id != patient_thread:
+                await self.workflow.checkpointer.adelete_thread(thread_id)
+
+    async def _prepare_run(self,
+                           thread_id: str,
+                           patient_info: Dict[str, Any],
+                           complaint: str,
+                           medical_records: str) -> Tuple[Dict[str, Any], Optional[PatientState]]:
+        """Return the checkpoint config and workflow inputs for a patient."""
+        config = {"configurable": {"thread_id": thread_id}}
+        patient = {
+            "patient_info": patient_info,
+            "complaint": complaint,
+            "medical_records": medical_records
+        }
+        
+        # If this patient's last run stopped partway with the same inputs,
+        # resume it (input None) so completed nodes aren't re-run
+        snapshot = await self.workflow.aget_state(config)
+        if snapshot.next and all(snapshot.values.get(key) == value for key, value in patient.items()):
+            logger.info("Resuming workflow for patient %s at %s", patient_info["patient_id"], snapshot.next)
+            return config, None
+        
+        # Fresh run: clear results an earlier run left in this thread
+        return config, {
+            **patient,
+            "front_desk_assessment": "",
+            "physician_assessment": "",
+            "radiology_report": "",
+            "needs_imaging": False,
+            "front_desk_logs": [],
+            "physician_logs": [],
+            "radiologist_logs": []
+        }
+
+    def _build_result(self, state: PatientState) -> Dict[str, Any]:
+        """Collect responses, logs and their markdown from a workflow state."""
+        # Default the fields a branch hasn't produced (yet)
+        responses = {
+            "front_desk_assessment": state.get("front_desk_assessment", ""),
+            "physician_assessment": state.get("physician_assessment", ""),
+            "radiology_report": state.get("radiology_report", ""),
+            "front_desk_logs": format_log_entries(state.get("front_desk_logs", [])),
+            "physician_logs": format_log_entries(state.get("physician_logs", [])),
+            "radiologist_logs": format_log_entries(state.get("radiologist_logs", []))
+        }
+        
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Collected responses: front desk %d chars, physician %d chars, radiology %d chars",
+                len(responses['front_desk_assessment']),
+                len(responses['physician_assessment']),
+                len(responses['radiology_report'])
+            )
+        
+        return {
+            **responses,
+            "formatted_assessment": self._format_assessment(responses),
+            "formatted_logs": self._format_logs(responses)
+        }
+
+    @staticmethod
+    def _error_result(error: Exception) -> Dict[str, Any]:
+        """Build the result returned when processing a patient fails."""
+        logger.error("Error processing patient: %s", error)
+        error_msg = f"Error in processing: {str(error)}"
+        error_assessment = f"""
 # Error in Processing
 
 An error occurred while processing the patient:
@@ -241,13 +393,18 @@ An error occurred while processing the patient:
 {error_msg}
 ```
 """
-            return {
-                "front_desk_assessment": error_msg,
-                "physician_assessment": error_msg,
-                "radiology_report": error_msg,
-                "front_desk_logs": [error_msg],
-                "physician_logs": [error_msg],
-                "radiologist_logs": [error_msg],
-                "formatted_assessment": error_assessment,
-                "formatted_logs": error_assessment
-            } 
\ No newline at end of file
+        return {
+            "front_desk_assessment": error_msg,
+            "physician_assessment": error_msg,
+            "radiology_report": error_msg,
+            "front_desk_logs": [error_msg],
+            "physician_logs": [error_msg],
+            "radiologist_logs": [error_msg],
+            "formatted_assessment": error_assessment,
+            "formatted_logs": error_assessment
+        }
+
+@lru_cache(maxsize=1)
+def get_graph() -> HospitalGraph:
+    """Return the process-wide HospitalGraph, creating it on first use."""
+    return HospitalGraph() 
\ No newline at end of file
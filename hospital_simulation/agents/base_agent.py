@@ -1,61 +1,240 @@
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 from langchain_groq import ChatGroq
 from langchain.prompts import PromptTemplate
 from langchain_core.runnables import RunnablePassthrough
 from langchain.schema import HumanMessage
+from groq import APIConnectionError, RateLimitError
+import tiktoken
+from tenacity import (
+    AsyncRetrying,
+    RetryCallState,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential_jitter
+)
+import asyncio
+import logging
 import os
-import time
+from contextvars import ContextVar
 from datetime import datetime
+from functools import lru_cache
+from hospital_simulation.utils.response_cache import ResponseCache
+
+logger = logging.getLogger(__name__)
+
+# (timestamp, step type, %-style message, message args); formatted only when read.
+# Args must be serializable since entries are checkpointed with the workflow state.
+LogEntry = Tuple[datetime, str, str, tuple]
+
+# Entries of the run in progress; a context variable so concurrent runs of a
+# shared agent each collect their own logs
+_run_logs: ContextVar[Optional[List[LogEntry]]] = ContextVar("_run_logs", default=None)
+
+def format_log_entries(entries: Iterable[LogEntry]) -> List[str]:
+    """Render raw log entries as "[timestamp] STEP: message" lines."""
+    return [
+        f"[{timestamp:%Y-%m-%d %H:%M:%S}] {step_type}: {message % tuple(args) if args else message}"
+        for timestamp, step_type, message, args in entries
+    ]
+
+# Small model used to condense over-long medical records
+SUMMARY_MODEL = "llama-3.1-8b-instant"
+SUMMARY_PROMPT = """Summarize the following medical records for a physician in at most {max_tokens} tokens.
+Keep diagnoses, medications, allergies, procedures, abnormal results and their dates.
+
+Medical Records:
+{records}
+"""
+
+@lru_cache(maxsize=1)
+def _token_encoding() -> tiktoken.Encoding:
+    # GPT-4's tokenizer is close enough to Llama's for budgeting prompt size
+    return tiktoken.encoding_for_model("gpt-4")
+
+@lru_cache(maxsize=1)
+def _summary_llm() -> ChatGroq:
+    return BaseAgent.create_llm(SUMMARY_MODEL, temperature=0)
+
+class EmptyResponseError(Exception):
+    """Raised when the LLM returns no content."""
+
+@lru_cache(maxsize=256)
+def _patient_header(name: Any, patient_id: Any, age: Any, gender: Any) -> str:
+    return f"- Name: {name}\n- ID: {patient_id}\n- Age: {age}\n- Gender: {gender}"
 
 class BaseAgent:
-    def __init__(self, model_name: str = "llama-3.3-70b-versatile"):
-        self.llm = ChatGroq(
-            groq_api_key=os.getenv("GROQ_API_KEY"),
-            model_name=model_name,
-            temperature=0.7,
-        )
+    # Concurrent Groq requests allowed per agent class; size to the account's limit.
+    # None reads GROQ_MAX_CONCURRENT_REQUESTS (default 4) when the first request is made.
+    max_concurrent_requests: Optional[int] = None
+    # Token budget for each free-text prompt input (complaint, medical records)
+    max_input_tokens: int = 2000
+    # Prompt inputs holding medical records, condensed by run() to max_input_tokens
+    records_inputs: Tuple[str, ...] = ()
+
+    def __init__(self,
+                 model_name: str = "llama-3.3-70b-versatile",
+                 temperature: float = 0.7,
+                 llm: Optional[ChatGroq] = None):
+        # Agents sharing a model can share one client (and its connection pool)
+        self.llm = llm or self.create_llm(model_name, temperature)
         self.chain = None
         self.prompt = None
+        self._format = None
         self.model_name = model_name
-        self.logs = []
-
-    def _log_step(self, step_type: str, message: str):
-        """Log a step with timestamp."""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_entry = f"[{timestamp}] {step_type}: {message}"
-        print(log_entry)
-        self.logs.append(log_entry)
-
-    def _call_llm(self, prompt: str, max_retries: int = 3) -> str:
-        """Call LLM with retry logic and logging."""
-        self._log_step("MODEL", f"Using {self.model_name}")
-        self._log_step("PROMPT", f"Sending prompt:\n{prompt}")
-        
-        for attempt in range(max_retries):
+        self.logs: List[LogEntry] = []
+        self.cache = ResponseCache.get_instance()
+        self._llm_key = f"{model_name}:{temperature}"
+
+    @staticmethod
+    def create_llm(model_name: str = "llama-3.3-70b-versatile", temperature: float = 0.7) -> ChatGroq:
+        """Create a Groq chat model client."""
+        return ChatGroq(
+            groq_api_key=os.getenv("GROQ_API_KEY"),
+            model_name=model_name,
+            temperature=temperature,
+        )
+
+    @staticmethod
+    def _render_patient_header(patient_info: Dict[str, Any]) -> str:
+        """Render the patient information block shared by all agent prompts.
+
+        Memoized, so the three agents handling a patient format it once.
+        """
+        return _patient_header(
+            patient_info['name'],
+            patient_info['patient_id'],
+            patient_info['age'],
+            patient_info['gender']
+        )
+
+    @staticmethod
+    def _truncate(text: str, max_tokens: int = 2000) -> str:
+        """Keep only the last ``max_tokens`` tokens of text."""
+        # Every token covers at least one UTF-8 byte, so text this short can't be over budget
+        if len(text.encode()) <= max_tokens:
+            return text
+        tokens = _token_encoding().encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        return _token_encoding().decode(tokens[-max_tokens:])
+
+    async def _condense_records(self, records: str, max_tokens: int = 2000) -> str:
+        """Fit medical records into ``max_tokens`` tokens.
+
+        Records over budget are summarized once by SUMMARY_MODEL; the summary is
+        cached by the records' content. Falls back to keeping the most recent
+        tokens if summarization fails.
+        """
+        if len(records.encode()) <= max_tokens or len(_token_encoding().encode(records)) <= max_tokens:
+            return records
+
+        prompt = SUMMARY_PROMPT.format(max_tokens=max_tokens, records=self._truncate(records, 24000))
+        llm_key = f"{SUMMARY_MODEL}:summary"
+        summary = await asyncio.to_thread(self.cache.lookup, prompt, llm_key)
+        if summary is None:
+            self._log_step("SUMMARY", "Summarizing medical records with %s", SUMMARY_MODEL)
             try:
-                self._log_step("REQUEST", f"Attempt {attempt + 1}/{max_retries}")
-                messages = [HumanMessage(content=prompt)]
-                response = self.llm.invoke(messages)
-                
-                if response and hasattr(response, 'content'):
-                    self._log_step("RESPONSE", f"Received response:\n{response.content}")
-                    return response.content
-                else:
-                    self._log_step("WARNING", "Empty or invalid response from LLM")
-                    if attempt < max_retries - 1:
-                        continue
+                async for attempt in self._retrying():
+                    with attempt:
+                        async with self._request_slots():
+                            response = await _summary_llm().ainvoke([HumanMessage(content=prompt)])
+                        summary = response.content
+                        if not summary:
+                            raise EmptyResponseError("Empty summary from LLM")
+                await asyncio.to_thread(self.cache.update, prompt, llm_key, summary)
             except Exception as e:
-                self._log_step("ERROR", f"Error: {str(e)}")
-                if attempt < max_retries - 1:
-                    wait_time = 2 ** attempt
-                    self._log_step("RETRY", f"Retrying in {wait_time} seconds...")
-                    time.sleep(wait_time)
-                else:
-                    self._log_step("FALLBACK", "Max retries reached. Using fallback response.")
-                    return self._get_fallback_response()
+                summary = None
+                self._log_step("ERROR", "Error summarizing records: %s", str(e))
+        if not summary:
+            self._log_step("WARNING", "Keeping the last %d tokens of medical records", max_tokens)
+            return self._truncate(records, max_tokens)
+        return self._truncate(summary, max_tokens)
+
+    def _log_step(self, step_type: str, message: str, *args: Any):
+        """Log a step with timestamp.
+
+        ``message`` is a %-style template; it is only rendered with ``args``
+        when the entry is read or debug logging is enabled.
+        """
+        logs = _run_logs.get()
+        (self.logs if logs is None else logs).append((datetime.now(), step_type, message, args))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s: " + message, step_type, *args)
+
+    async def _call_llm(self,
+                        prompt: str,
+                        max_retries: int = 3,
+                        on_token: Optional[Callable[[str], None]] = None) -> str:
+        """Stream the LLM response with retry logic and logging.
+
+        ``on_token`` is called with each chunk as it arrives (or once with the
+        whole text on a cache hit). Once retries are exhausted the last error is
+        raised, so the workflow can resume this call later.
+        """
+        self._log_step("MODEL", "Using %s", self.model_name)
+        self._log_step("PROMPT", "Sending prompt:\n%s", prompt)
+
+        # SQLite I/O runs off the event loop so concurrent patients aren't blocked
+        cached = await asyncio.to_thread(self.cache.lookup, prompt, self._llm_key)
+        if cached is not None:
+            self._log_step("CACHE", "Cache hit, using cached response:\n%s", cached)
+            if on_token:
+                on_token(cached)
+            return cached
         
-        self._log_step("FALLBACK", "All attempts failed. Using fallback response.")
-        return self._get_fallback_response()
+        try:
+            async for attempt in self._retrying(max_retries):
+                with attempt:
+                    self._log_step("REQUEST", "Attempt %d/%d", attempt.retry_state.attempt_number, max_retries)
+                    # Hold a request slot only while talking to Groq, not while backing off
+                    async with self._request_slots():
+                        content = await self._stream_llm(prompt, on_token)
+        except Exception as e:
+            self._log_step("ERROR", "All attempts failed: %s", str(e))
+            raise
+
+        self._log_step("RESPONSE", "Received response:\n%s", content)
+        await asyncio.to_thread(self.cache.update, prompt, self._llm_key, content)
+        return content
+
+    def _retrying(self, max_retries: int = 3) -> AsyncRetrying:
+        """Retry policy for Groq requests: transient errors and empty responses."""
+        return AsyncRetrying(
+            stop=stop_after_attempt(max_retries),
+            # 1s, 2s, 4s... capped at 30s plus up to 0.5s of jitter, slept with asyncio.sleep
+            wait=wait_exponential_jitter(initial=1, max=30, jitter=0.5),
+            retry=retry_if_exception_type((RateLimitError, APIConnectionError, EmptyResponseError)),
+            before_sleep=self._log_retry,
+            reraise=True
+        )
+
+    async def _stream_llm(self, prompt: str, on_token: Optional[Callable[[str], None]] = None) -> str:
+        """Stream one LLM response, joining the chunks once at the end."""
+        messages = [HumanMessage(content=prompt)]
+        chunks = []
+        async for chunk in self.llm.astream(messages):
+            if chunk.content:
+                chunks.append(chunk.content)
+                if on_token:
+                    on_token(chunk.content)
+        content = "".join(chunks)
+        if not content:
+            raise EmptyResponseError("Empty or invalid response from LLM")
+        return content
+
+    def _log_retry(self, retry_state: RetryCallState):
+        """Log a failed attempt before tenacity backs off."""
+        self._log_step("ERROR", "Error: %s", str(retry_state.outcome.exception()))
+        self._log_step("RETRY", "Retrying in %.1f seconds...", retry_state.next_action.sleep)
+
+    @classmethod
+    def _request_slots(cls) -> asyncio.Semaphore:
+        """Semaphore bounding this agent class's concurrent Groq requests."""
+        if "_semaphore" not in cls.__dict__:
+            # Read here rather than at import, so a value from .env is already loaded
+            limit = cls.max_concurrent_requests or int(os.getenv("GROQ_MAX_CONCURRENT_REQUESTS", "4"))
+            cls._semaphore = asyncio.Semaphore(limit)
+        return cls._semaphore
 
     def _get_fallback_response(self) -> str:
         """Get a fallback response in case of LLM failure."""
@@ -66,26 +245,38 @@ Please proceed with standard protocols and consider the following general guidel
 - Consider basic diagnostic tests
 - Consult with colleagues if needed
 - Ensure patient comfort and safety"""
-        self._log_step("FALLBACK", f"Using fallback response:\n{fallback}")
+        self._log_step("FALLBACK", "Using fallback response:\n%s", fallback)
         return fallback
 
-    def run(self, inputs: Dict[str, Any]) -> Dict[str, str]:
+    async def run(self,
+                  inputs: Dict[str, Any],
+                  on_token: Optional[Callable[[str], None]] = None) -> Dict[str, str]:
         """Run the agent's chain with the given inputs."""
-        if not self.prompt:
+        if not self._format:
             raise ValueError("Prompt not initialized. Call setup_chain first.")
         
-        self._log_step("INPUT", f"Received inputs: {inputs}")
+        logs: List[LogEntry] = []
+        token = _run_logs.set(logs)
+        try:
+            # Condensed here so summarization logs land in this run's entries
+            for key in self.records_inputs:
+                inputs = {**inputs, key: await self._condense_records(inputs[key], self.max_input_tokens)}
+            self._log_step("INPUT", "Received inputs: %s", inputs)
         
-        # Format the prompt
-        formatted_prompt = self.prompt.format(**inputs)
+            # Format the prompt with the template's bound str.format, skipping
+            # PromptTemplate's per-call variable validation
+            formatted_prompt = self._format(**inputs)
         
-        # Call LLM and get response
-        response = self._call_llm(formatted_prompt)
+            # Call LLM and get response
+            response = await self._call_llm(formatted_prompt, on_token=on_token)
         
-        # Ensure we have a valid response
-        if not response or not isinstance(response, str):
-            response = self._get_fallback_response()
+            # Ensure we have a valid response
+            if not response or not isinstance(response, str):
+                response = self._get_fallback_response()
         
-        result = {"response": response.strip(), "logs": self.logs}
-        self._log_step("OUTPUT", f"Final response: {response.strip()}")
-        return result 
\ No newline at end of file
+            response = response.strip()
+            result = {"response": response, "logs": logs}
+            self._log_step("OUTPUT", "Final response: %s", response)
+            return result
+        finally:
+            _run_logs.reset(token) 
\ No newline at end of file
@@ -1,10 +1,14 @@
-from typing import Dict, Any
+import logging
+from typing import Dict, Any, Optional
+from langchain_groq import ChatGroq
 from hospital_simulation.agents.base_agent import BaseAgent
 from langchain.prompts import PromptTemplate
 
+logger = logging.getLogger(__name__)
+
 class FrontDeskAgent(BaseAgent):
-    def __init__(self, model_name: str = "llama-3.3-70b-versatile"):
-        super().__init__(model_name)
+    def __init__(self, model_name: str = "llama-3.1-8b-instant", llm: Optional[ChatGroq] = None):
+        super().__init__(model_name, llm=llm)
         self._setup_prompt()
 
     def _setup_prompt(self):
@@ -17,10 +21,7 @@ class FrontDeskAgent(BaseAgent):
 5. Provide clear instructions
 
 Patient Information:
-- Name: {patient_info[name]}
-- ID: {patient_info[patient_id]}
-- Age: {patient_info[age]}
-- Gender: {patient_info[gender]}
+{patient_header}
 
 Primary Complaints/Symptoms:
 {complaint}
@@ -36,19 +37,19 @@ Respond in a professional, empathetic manner, structured with clear sections.
 """
         self.prompt = PromptTemplate(
             template=prompt_template,
-            input_variables=["patient_info", "complaint"]
+            input_variables=["patient_header", "complaint"]
         )
+        self._format = prompt_template.format
 
-    def process_patient(self, patient_info: Dict[str, Any], complaint: str) -> Dict[str, str]:
+    async def process_patient(self, patient_info: Dict[str, Any], complaint: str) -> Dict[str, str]:
         """Process a new patient and provide recommendations."""
-        print("\n=== Front Desk Processing ===")
-        print(f"Processing patient: {patient_info['name']}")
-        print(f"Symptoms: {complaint}")
+        logger.info("Front desk processing patient %s", patient_info['patient_id'])
+        logger.debug("Symptoms: %s", complaint)
         
-        result = self.run({
-            "patient_info": patient_info,
-            "complaint": complaint
+        result = await self.run({
+            "patient_header": self._render_patient_header(patient_info),
+            "complaint": self._truncate(complaint, self.max_input_tokens)
         })
         
-        print("Front desk assessment completed")
+        logger.info("Front desk assessment completed for patient %s", patient_info['patient_id'])
         return result 
\ No newline at end of file
@@ -1,10 +1,16 @@
-from typing import Dict, Any
+import logging
+from typing import Callable, Dict, Any, Optional
+from langchain_groq import ChatGroq
 from hospital_simulation.agents.base_agent import BaseAgent
 from langchain.prompts import PromptTemplate
 
+logger = logging.getLogger(__name__)
+
 class PhysicianAgent(BaseAgent):
-    def __init__(self, model_name: str = "llama-3.3-70b-versatile"):
-        super().__init__(model_name)
+    records_inputs = ("medical_records",)
+
+    def __init__(self, model_name: str = "llama-3.3-70b-versatile", llm: Optional[ChatGroq] = None):
+        super().__init__(model_name, llm=llm)
         self._setup_prompt()
 
     def _setup_prompt(self):
@@ -17,10 +23,7 @@ class PhysicianAgent(BaseAgent):
 5. Outline treatment plan
 
 Patient Information:
-- Name: {patient_info[name]}
-- ID: {patient_info[patient_id]}
-- Age: {patient_info[age]}
-- Gender: {patient_info[gender]}
+{patient_header}
 
 Current Symptoms:
 {symptoms}
@@ -58,20 +61,21 @@ Provide your assessment in a clear, structured format, using medical terminology
 """
         self.prompt = PromptTemplate(
             template=prompt_template,
-            input_variables=["patient_info", "symptoms", "medical_records"]
+            input_variables=["patient_header", "symptoms", "medical_records"]
         )
+        self._format = prompt_template.format
 
-    def examine_patient(self, patient_info: Dict[str, Any], symptoms: str, medical_records: str) -> Dict[str, str]:
+    async def examine_patient(self, patient_info: Dict[str, Any], symptoms: str, medical_records: str,
+                              on_token: Optional[Callable[[str], None]] = None) -> Dict[str, str]:
         """Examine a patient and provide medical recommendations."""
-        print("\n=== Physician Examination ===")
-        print(f"Examining patient: {patient_info['name']}")
-        print(f"Symptoms: {symptoms}")
+        logger.info("Physician examining patient %s", patient_info['patient_id'])
+        logger.debug("Symptoms: %s", symptoms)
         
-        result = self.run({
-            "patient_info": patient_info,
-            "symptoms": symptoms,
+        result = await self.run({
+            "patient_header": self._render_patient_header(patient_info),
+            "symptoms": self._truncate(symptoms, self.max_input_tokens),
             "medical_records": medical_records
-        })
+        }, on_token=on_token)
         
-        print("Physician examination completed")
+        logger.info("Physician examination completed for patient %s", patient_info['patient_id'])
         return result 
\ No newline at end of file
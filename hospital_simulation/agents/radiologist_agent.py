@@ -1,10 +1,19 @@
-from typing import Dict, Any
+import logging
+import re
+from typing import Dict, Any, Optional
+from langchain_groq import ChatGroq
 from hospital_simulation.agents.base_agent import BaseAgent
 from langchain.prompts import PromptTemplate
 
+_FINDING_RE = re.compile(r"PNEUMONIA|NORMAL")
+
+logger = logging.getLogger(__name__)
+
 class RadiologistAgent(BaseAgent):
-    def __init__(self, model_name: str = "llama-3.3-70b-versatile"):
-        super().__init__(model_name)
+    records_inputs = ("clinical_history",)
+
+    def __init__(self, model_name: str = "llama-3.3-70b-versatile", llm: Optional[ChatGroq] = None):
+        super().__init__(model_name, llm=llm)
         self._setup_prompt()
 
     def _setup_prompt(self):
@@ -17,10 +26,7 @@ class RadiologistAgent(BaseAgent):
 5. Suggest follow-up imaging if needed
 
 Patient Information:
-- Name: {patient_info[name]}
-- ID: {patient_info[patient_id]}
-- Age: {patient_info[age]}
-- Gender: {patient_info[gender]}
+{patient_header}
 
 Clinical History:
 {clinical_history}
@@ -58,25 +64,26 @@ Provide your report in a clear, structured format using standard radiological te
 """
         self.prompt = PromptTemplate(
             template=prompt_template,
-            input_variables=["patient_info", "imaging_request", "clinical_history"]
+            input_variables=["patient_header", "imaging_request", "clinical_history"]
         )
+        self._format = prompt_template.format
 
-    def analyze_imaging(self, patient_info: Dict[str, Any], imaging_request: str, clinical_history: str) -> Dict[str, str]:
+    async def analyze_imaging(self, patient_info: Dict[str, Any], imaging_request: str, clinical_history: str) -> Dict[str, str]:
         """Analyze imaging results and provide professional interpretation."""
-        print("\n=== Radiology Analysis ===")
-        print(f"Analyzing imaging for patient: {patient_info['name']}")
+        logger.info("Radiologist analyzing imaging for patient %s", patient_info['patient_id'])
         
         # Add X-ray analysis results to the request
-        if "PNEUMONIA" in imaging_request:
+        findings = set(_FINDING_RE.findall(imaging_request))
+        if "PNEUMONIA" in findings:
             imaging_request = f"X-ray analysis indicates high probability of pneumonia. Detailed results: {imaging_request}"
-        elif "NORMAL" in imaging_request:
+        elif "NORMAL" in findings:
             imaging_request = f"X-ray analysis suggests normal findings. Detailed results: {imaging_request}"
         
-        result = self.run({
-            "patient_info": patient_info,
+        result = await self.run({
+            "patient_header": self._render_patient_header(patient_info),
             "imaging_request": imaging_request,
             "clinical_history": clinical_history
         })
         
-        print("Radiology analysis completed")
+        logger.info("Radiology analysis completed for patient %s", patient_info['patient_id'])
         return result 
\ No newline at end of file
@@ -1,45 +1,118 @@
+import numpy as np
 import pandas as pd
-import kagglehub
-from typing import List, Dict, Tuple
-from langchain_groq import ChatGroq
-from langchain.output_parsers import ResponseSchema, StructuredOutputParser
-from langchain.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import JsonOutputParser
+from typing import TYPE_CHECKING, BinaryIO, List, Dict, Optional, Tuple
 import os
-import json
-from datasets import load_dataset
-from langchain.schema import HumanMessage
+import asyncio
+import hashlib
+from collections import OrderedDict
+from functools import cached_property
+from pathlib import Path
 import time
 import backoff  # For exponential backoff
+import orjson
+
+# LLM, dataset and cache clients are imported where they are first used, so
+# loading already-preprocessed data does not pay for them
+if TYPE_CHECKING:
+    import diskcache
+    from langchain_groq import ChatGroq
+
+# Low-cardinality columns stored as pandas categoricals so comparisons run on integer codes
+CATEGORICAL_COLUMNS = ['Gender', 'Outcome Variable', 'Difficulty Breathing']
+
+_ID_ALPHABET = np.frombuffer(b'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ', dtype='S1')
+PATIENT_ID_PATTERN = r'IN[0-9A-Z]{11}'
+
+def generate_patient_ids(n: int, rng: np.random.Generator) -> np.ndarray:
+    """Generate n 13-character patient IDs: 'IN' followed by 11 base-36 characters."""
+    codes = np.empty((n, 13), dtype='S1')
+    codes[:, 0], codes[:, 1] = b'I', b'N'
+    codes[:, 2:] = _ID_ALPHABET[rng.integers(0, len(_ID_ALPHABET), size=(n, 11))]
+    # View each row as one 13-byte value instead of joining characters per ID
+    return codes.view('S13').ravel().astype(str)
+
+def invalid_patient_ids(ids: pd.Series) -> np.ndarray:
+    """Return a mask of IDs that are malformed or repeat an earlier ID."""
+    ids = ids.astype('string')
+    return (~ids.str.fullmatch(PATIENT_ID_PATTERN).fillna(False) | ids.duplicated()).to_numpy(dtype=bool)
+
+def _format_category_counts(series: pd.Series) -> str:
+    """Format value counts of a categorical series, counted directly on its integer codes."""
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        return series.value_counts().to_string()
+    codes, counts = np.unique(series.cat.codes.to_numpy(), return_counts=True)
+    categories = series.cat.categories
+    width = max((len(str(category)) for category in categories), default=0)
+    return "\n".join(
+        f"{str(categories[code]).ljust(width)}  {count}"
+        for code, count in sorted(zip(codes, counts), key=lambda item: -item[1])
+        if code >= 0  # -1 marks missing values
+    )
+
+def _extract_json_array(text: str) -> Optional[str]:
+    """Return the first balanced JSON array in text, scanning it once."""
+    start = text.find('[')
+    if start == -1:
+        return None
+    depth = 0
+    in_string = escaped = False
+    for i in range(start, len(text)):
+        char = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '[':
+            depth += 1
+        elif char == ']':
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
 
 class DataPreparation:
     def __init__(self, model_name: str = 'llama-3.3-70b-versatile'):
         print(f"\nInitializing DataPreparation with model: {model_name}")
-        self.llm = ChatGroq(
-            model=model_name,
-            temperature=0.7,
-            groq_api_key=os.getenv("GROQ_API_KEY")
-        )
+        self.model_name = model_name
         self.patient_df = None
         self.all_patients_name_id = None
         self.x_ray_dataset = None
         self.max_retries = 5
         self.batch_size = 50  # Generate in smaller batches
+        self.concurrency_limit = 8  # Max batches in flight at once
+        self.output_dir = Path(__file__).parent / "processed"
+        self._index_cache = OrderedDict()  # frozenset(conditions) -> positions of matching rows, LRU order
+        self.index_cache_size = 128  # Filter combinations kept in _index_cache
+        self._indexed_df = None  # frame the cached positions refer to
+
+    @staticmethod
+    def _to_categorical(df: pd.DataFrame) -> pd.DataFrame:
+        """Cast the low-cardinality columns present in df to categorical dtype."""
+        for column in CATEGORICAL_COLUMNS:
+            if column in df.columns:
+                df[column] = df[column].astype('category')
+        return df
 
     def prepare_medical_dataset(self) -> pd.DataFrame:
         """Load and prepare the disease symptoms dataset."""
         try:
             print("\n=== Loading Medical Dataset ===")
             print("Downloading dataset from Kaggle...")
+            import kagglehub
             path = kagglehub.dataset_download("uom190346a/disease-symptoms-and-patient-profile-dataset")
             file_name = '/Disease_symptom_and_patient_profile_dataset.csv'
-            self.patient_df = pd.read_csv(path + file_name)
+            self.patient_df = self._to_categorical(pd.read_csv(path + file_name))
             
             # Print dataset statistics
             print(f"\nDataset Statistics:")
             print(f"Total records: {len(self.patient_df)}")
             print(f"Gender distribution:")
-            print(self.patient_df['Gender'].value_counts().to_string())
+            print(_format_category_counts(self.patient_df['Gender']))
             print(f"\nColumns: {', '.join(self.patient_df.columns)}")
             
             return self.patient_df
@@ -47,18 +120,19 @@ class DataPreparation:
         except Exception as e:
             print(f"\nError loading dataset: {e}")
             print("Creating sample dataset for testing...")
-            self.patient_df = pd.DataFrame({
+            self.patient_df = self._to_categorical(pd.DataFrame({
                 'Gender': ['Male', 'Female'] * 5,
                 'Age': [25, 30, 45, 35, 50, 28, 42, 33, 55, 40],
                 'Difficulty Breathing': ['Yes', 'No'] * 5,
                 'Outcome Variable': ['Positive', 'Negative'] * 5
-            })
+            }))
             return self.patient_df
 
     def load_xray_dataset(self):
         """Load chest X-ray dataset."""
         try:
             print("Loading X-ray dataset...")
+            from datasets import load_dataset
             self.x_ray_dataset = load_dataset("keremberke/chest-xray-classification", name="full")
             print("X-ray dataset loaded successfully")
             return self.x_ray_dataset
@@ -66,14 +140,54 @@ class DataPreparation:
             print(f"Error loading X-ray dataset: {e}")
             return None
 
+    @cached_property
+    def llm(self) -> "ChatGroq":
+        """Chat model used for LLM-based identity generation."""
+        from langchain_groq import ChatGroq
+        return ChatGroq(
+            model=self.model_name,
+            temperature=0.7,
+            groq_api_key=os.getenv("GROQ_API_KEY")
+        )
+
+    @cached_property
+    def batch_cache(self) -> "diskcache.Cache":
+        """On-disk cache of generated identity batches."""
+        import diskcache
+        self.output_dir.mkdir(exist_ok=True)
+        return diskcache.Cache(str(self.output_dir / "llm_cache"))
+
+    def _batch_key(self, num_records: int, ratio: float, batch_index: int) -> str:
+        """Cache key for a batch; the index keeps batches of equal size distinct."""
+        raw = f"{num_records}|{round(ratio, 2)}|{self.model_name}|{batch_index}"
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    @staticmethod
+    def _valid_records(records: List[Dict]) -> List[Dict]:
+        """Keep only records that carry every required identity field."""
+        fields = ("First_Name", "Last_Name", "Patient_ID", "G_Gender")
+        return [
+            record for record in records
+            if isinstance(record, dict) and all(record.get(field) for field in fields)
+        ]
+
+    async def _agenerate_batch(self, num_records: int, ratio: float, batch_index: int = 0) -> List[Dict]:
+        """Generate a batch of patient records, reusing a cached result."""
+        key = self._batch_key(num_records, ratio, batch_index)
+        cached = self.batch_cache.get(key)
+        if cached:
+            print(f"\nUsing cached batch {batch_index} ({len(cached)} records)")
+            return cached
+        return await self._arequest_batch(num_records, ratio, key)
+
     @backoff.on_exception(
         backoff.expo,
         (Exception),
         max_tries=5,
         giveup=lambda e: "Invalid API key" in str(e)
     )
-    def _generate_batch(self, num_records: int, ratio: float) -> List[Dict]:
-        """Generate a batch of patient records with retry logic."""
+    async def _arequest_batch(self, num_records: int, ratio: float, key: str) -> List[Dict]:
+        """Request a batch of patient records from the LLM with retry logic."""
         prompt = f"""Generate {num_records} Indian patient records in JSON array format.
 The ratio of Female to Male should be {ratio}:1.
 Each record must have these exact fields:
@@ -95,23 +209,25 @@ Example format:
 Return ONLY the JSON array with {num_records} records."""
 
         print(f"\nGenerating batch of {num_records} records...")
+        from langchain.schema import HumanMessage
         messages = [HumanMessage(content=prompt)]
         
         try:
-            output = self.llm.invoke(messages)
+            output = await self.llm.ainvoke(messages)
             text = str(output.content)
             
             # Extract JSON from the response
-            start = text.find('[')
-            end = text.rfind(']') + 1
+            json_str = _extract_json_array(text)
             
-            if start == -1 or end == 0:
+            if json_str is None:
                 print("No valid JSON found in response. Response preview:")
                 print(text[:200])
                 return []
                 
-            json_str = text[start:end]
-            return json.loads(json_str)
+            records = self._valid_records(orjson.loads(json_str))
+            if records:
+                self.batch_cache.set(key, records)
+            return records
             
         except Exception as e:
             print(f"Error in batch generation: {str(e)}")
@@ -119,8 +235,149 @@ Return ONLY the JSON array with {num_records} records."""
                 print(f"Response status: {e.response.status_code}")
             return []
 
-    def generate_patient_identities(self) -> pd.DataFrame:
-        """Generate synthetic patient identities with batching and retries."""
+    async def _agenerate_batches(self, batches: List[Tuple[int, int]], ratio: float,
+                                 checkpoint: BinaryIO = None) -> List[List[Dict]]:
+        """Generate (index, size) batches concurrently, bounded by the concurrency limit.
+
+        Each completed batch is appended to ``checkpoint`` as it arrives, so an
+        interrupted run keeps everything finished so far.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency_limit)
+
+        async def bounded(batch_index: int, num_records: int) -> List[Dict]:
+            async with semaphore:
+                records = await self._agenerate_batch(num_records, ratio, batch_index)
+            if records and checkpoint is not None:
+                checkpoint.write(b"".join(
+                    orjson.dumps({**record, "_batch": batch_index}) + b"\n"
+                    for record in records
+                ))
+                checkpoint.flush()
+            return records
+
+        return await asyncio.gather(*(bounded(i, n) for i, n in batches))
+
+    @property
+    def checkpoint_file(self) -> Path:
+        return self.output_dir / "identities.jsonl"
+
+    def _checkpoint_header(self, total_records: int, ratio: float) -> bytes:
+        """First checkpoint line, identifying the run the records belong to."""
+        run = {"total_records": total_records, "ratio": round(ratio, 2), "model": self.model_name}
+        return orjson.dumps({"_run": run}) + b"\n"
+
+    def _load_checkpoint(self, total_records: int, ratio: float) -> Tuple[List[Dict], int]:
+        """Load records from an interrupted run with the same parameters and the next unused batch index.
+
+        A checkpoint written for other parameters is discarded.
+        """
+        records = []
+        next_index = 0
+        if not self.checkpoint_file.exists():
+            return records, next_index
+        header = self._checkpoint_header(total_records, ratio)
+        with open(self.checkpoint_file, "rb") as fh:
+            matches = fh.readline() == header
+            for line in fh if matches else ():
+                try:
+                    record = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    continue  # Partial line from an interrupted write
+                next_index = max(next_index, record.pop("_batch", 0) + 1)
+                records.append(record)
+        if not matches:
+            print("Discarding checkpoint from a run with different parameters")
+            self.checkpoint_file.unlink()
+        return records, next_index
+
+    def _generate_identities_with_llm(self, total_records: int, ratio: float) -> List[Dict]:
+        """Generate identities with the LLM in concurrent, cached and checkpointed batches."""
+        # One event loop for the whole run; the async client must not outlive its loop
+        return asyncio.run(self._agenerate_identities_with_llm(total_records, ratio))
+
+    async def _agenerate_identities_with_llm(self, total_records: int, ratio: float) -> List[Dict]:
+        start_time = time.time()
+        all_records, next_index = self._load_checkpoint(total_records, ratio)
+        records_generated = len(all_records)
+        if records_generated:
+            print(f"Resuming from checkpoint with {records_generated} records")
+
+        pending = []
+        self.output_dir.mkdir(exist_ok=True)
+        with open(self.checkpoint_file, "ab") as checkpoint:
+            if checkpoint.tell() == 0:
+                checkpoint.write(self._checkpoint_header(total_records, ratio))
+            while records_generated < total_records:
+                if not pending:
+                    # Plan new batches for whatever is still missing
+                    remaining = total_records - records_generated
+                    for offset in range(0, remaining, self.batch_size):
+                        pending.append((next_index, min(self.batch_size, remaining - offset)))
+                        next_index += 1
+            
+                print(f"\nProgress: {records_generated}/{total_records} records")
+                print(f"Dispatching {len(pending)} batches (up to {self.concurrency_limit} concurrently)...")
+                batches = await self._agenerate_batches(pending, ratio, checkpoint)
+            
+                failed = []
+                for spec, batch in zip(pending, batches):
+                    if batch:
+                        all_records.extend(batch)
+                    else:
+                        failed.append(spec)
+                records_generated = len(all_records)
+                print(f"Successfully generated {len(pending) - len(failed)}/{len(pending)} batches")
+            
+                # Retry failed batches under the same index so their cache keys stay stable
+                pending = failed
+                if pending:
+                    print(f"{len(pending)} batches failed, retrying...")
+                    await asyncio.sleep(2)  # Add delay before retry
+            
+                # Print progress
+                elapsed_time = time.time() - start_time
+                if records_generated > 0:
+                    avg_time_per_record = elapsed_time / records_generated
+                    estimated_remaining = avg_time_per_record * max(total_records - records_generated, 0)
+                    print(f"Elapsed time: {elapsed_time:.1f}s, Estimated remaining time: {estimated_remaining:.1f}s")
+
+        # The run is complete, so there is nothing left to resume
+        self.checkpoint_file.unlink()
+        return all_records[:total_records]
+
+    def _fast_generate_identities(self, n: int, female_ratio: float, seed: int = None) -> pd.DataFrame:
+        """Generate identities locally with Faker name pools and vectorized NumPy IDs."""
+        from faker import Faker
+        fake = Faker('en_IN')
+        fake.seed_instance(0)
+        male_names = sorted({fake.first_name_male() for _ in range(1000)})
+        female_names = sorted({fake.first_name_female() for _ in range(1000)})
+        last_names = sorted({fake.last_name() for _ in range(1000)})
+
+        rng = np.random.default_rng(seed)
+        n_female = round(n * female_ratio / (1 + female_ratio))
+        genders = np.array(['Female'] * n_female + ['Male'] * (n - n_female))
+        is_female = genders == 'Female'
+
+        first_names = np.where(
+            is_female,
+            rng.choice(female_names, size=n),
+            rng.choice(male_names, size=n)
+        )
+
+        return pd.DataFrame({
+            'First_Name': first_names,
+            'Last_Name': rng.choice(last_names, size=n),
+            'Patient_ID': generate_patient_ids(n, rng),
+            'G_Gender': genders
+        })
+
+    def generate_patient_identities(self, use_llm: bool = False) -> pd.DataFrame:
+        """Generate synthetic patient identities.
+
+        Identities are sampled locally by default; set ``use_llm`` to generate
+        them with the LLM in batches instead.
+        """
         if self.patient_df is None:
             raise ValueError("Please load medical dataset first using prepare_medical_dataset()")
 
@@ -137,42 +394,30 @@ Return ONLY the JSON array with {num_records} records."""
         print(f"- Ratio (F/M): {ratio:.2f}")
 
         start_time = time.time()
-        all_records = []
-        total_records = len(self.patient_df)
-        records_generated = 0
-
-        while records_generated < total_records:
-            remaining = total_records - records_generated
-            current_batch_size = min(self.batch_size, remaining)
-            
-            print(f"\nProgress: {records_generated}/{total_records} records")
-            batch = self._generate_batch(current_batch_size, ratio)
-            
-            if batch:
-                all_records.extend(batch)
-                records_generated = len(all_records)
-                print(f"Successfully generated {len(batch)} records")
-            else:
-                print("Batch generation failed, retrying...")
-                time.sleep(2)  # Add delay before retry
-            
-            # Print progress
-            elapsed_time = time.time() - start_time
-            if records_generated > 0:
-                avg_time_per_record = elapsed_time / records_generated
-                estimated_remaining = avg_time_per_record * (total_records - records_generated)
-                print(f"Elapsed time: {elapsed_time:.1f}s, Estimated remaining time: {estimated_remaining:.1f}s")
+        if use_llm:
+            all_records = self._generate_identities_with_llm(len(self.patient_df), ratio)
+        else:
+            all_records = self._fast_generate_identities(len(self.patient_df), ratio)
 
         # Convert to DataFrame and validate
         print("\nProcessing generated records...")
         self.all_patients_name_id = pd.DataFrame(all_records)
         self.all_patients_name_id.rename(columns={"G_Gender": "Gender"}, inplace=True)
+        self._to_categorical(self.all_patients_name_id)
+        if use_llm:
+            # LLM output only loosely follows the ID format; replace bad or repeated IDs locally
+            invalid = invalid_patient_ids(self.all_patients_name_id['Patient_ID'])
+            if invalid.any():
+                print(f"Regenerating {invalid.sum()} invalid or duplicate patient IDs")
+                self.all_patients_name_id.loc[invalid, 'Patient_ID'] = generate_patient_ids(
+                    int(invalid.sum()), np.random.default_rng()
+                )
         
         # Print generation statistics
         print(f"\nGeneration completed in {time.time() - start_time:.1f} seconds")
         print(f"Generated {len(self.all_patients_name_id)} patient identities")
         print("\nGenerated gender distribution:")
-        print(self.all_patients_name_id['Gender'].value_counts().to_string())
+        print(_format_category_counts(self.all_patients_name_id['Gender']))
         
         # Verify data quality
         print("\nVerifying data quality...")
@@ -194,31 +439,27 @@ Return ONLY the JSON array with {num_records} records."""
 
         print("\n=== Merging Patient Data ===")
         
-        # Split by gender
-        print("Splitting data by gender...")
-        gender_counts = self.patient_df['Gender'].value_counts()
-        unique_males = self.all_patients_name_id[self.all_patients_name_id['Gender'] == 'Male'].drop_duplicates().head(gender_counts['Male'])
-        unique_females = self.all_patients_name_id[self.all_patients_name_id['Gender'] == 'Female'].drop_duplicates().head(gender_counts['Female'])
-
-        patient_male = self.patient_df[self.patient_df['Gender'] == 'Male'].reset_index(drop=True)
-        patient_female = self.patient_df[self.patient_df['Gender'] == 'Female'].reset_index(drop=True)
-
-        print("\nMerging records...")
-        # Merge data
-        updated_male_patients = pd.concat([
-            patient_male.reset_index(drop=True),
-            unique_males[0:patient_male.shape[0]].reset_index(drop=True)
-        ], axis=1)
-
-        updated_female_patients = pd.concat([
-            patient_female.reset_index(drop=True),
-            unique_females[0:patient_female.shape[0]].reset_index(drop=True)
-        ], axis=1)
-
-        # Combine and clean
-        print("Combining and cleaning data...")
-        updated_patient_df = pd.concat([updated_male_patients, updated_female_patients], axis=0)
-        updated_patient_df = updated_patient_df.loc[:, ~updated_patient_df.columns.duplicated()]
+        identity_columns = ['First_Name', 'Last_Name', 'Patient_ID']
+        updated_patient_df = self.patient_df.copy()
+        for column in identity_columns:
+            updated_patient_df[column] = None
+        positions = [updated_patient_df.columns.get_loc(column) for column in identity_columns]
+
+        print("Assigning identities by gender...")
+        # One grouping pass per frame instead of a full scan per gender
+        patient_rows = updated_patient_df.groupby('Gender', sort=False, observed=True).indices
+        identity_groups = self.all_patients_name_id.groupby('Gender', sort=False, observed=True)
+        for gender, rows in patient_rows.items():
+            if gender not in identity_groups.groups:
+                continue
+            identities = (
+                identity_groups.get_group(gender)
+                .drop_duplicates(subset='Patient_ID')
+                .sample(frac=1, random_state=0)
+                .head(len(rows))
+            )
+            # Direct block assignment; patients without a matching identity keep None
+            updated_patient_df.iloc[rows[:len(identities)], positions] = identities[identity_columns].to_numpy()
         
         print(f"\nMerge completed:")
         print(f"- Total records: {len(updated_patient_df)}")
@@ -228,25 +469,56 @@ Return ONLY the JSON array with {num_records} records."""
         
         return updated_patient_df
 
-    def get_random_patient(self, conditions: dict = None) -> pd.Series:
-        """Get a random patient matching the specified conditions."""
+    @staticmethod
+    def _filter_patients(df: pd.DataFrame, conditions: dict = None) -> pd.DataFrame:
+        """Filter patients on conditions with a single fused query expression.
+
+        A condition value is either a scalar to match exactly or a (low, high)
+        tuple for an inclusive range. Ranges are written as chained comparisons,
+        which numexpr (pandas' default engine when installed) fuses into one pass.
+        """
+        if not conditions:
+            return df
+
+        terms = []
+        params = {}
+        for i, (column, value) in enumerate(conditions.items()):
+            if isinstance(value, tuple) and len(value) == 2:
+                params[f"lo{i}"], params[f"hi{i}"] = value
+                terms.append(f"@lo{i} <= `{column}` <= @hi{i}")
+            else:
+                params[f"v{i}"] = value
+                terms.append(f"`{column}` == @v{i}")
+        return df.query(" and ".join(terms), local_dict=params)
+
+    def _load_patients(self) -> pd.DataFrame:
+        """Return the merged patient frame, building it on first use."""
         if self.patient_df is None:
             self.prepare_medical_dataset()
             self.generate_patient_identities()
             self.patient_df = self.merge_patient_data()
+        return self.patient_df
 
-        if conditions:
-            mask = pd.Series(True, index=self.patient_df.index)
-            for column, value in conditions.items():
-                if isinstance(value, tuple) and len(value) == 2:
-                    mask &= self.patient_df[column].between(value[0], value[1])
-                else:
-                    mask &= self.patient_df[column] == value
-            filtered_df = self.patient_df[mask]
+    def get_random_patient(self, conditions: dict = None) -> pd.Series:
+        """Get a random patient matching the specified conditions."""
+        df = self._load_patients()
+        
+        # Cached positions are only valid for the frame they were computed on
+        if df is not self._indexed_df:
+            self._index_cache.clear()
+            self._indexed_df = df
+        
+        key = frozenset(conditions.items()) if conditions else frozenset()
+        rows = self._index_cache.get(key)
+        if rows is None:
+            rows = df.index.get_indexer(self._filter_patients(df, conditions).index)
+            self._index_cache[key] = rows
+            if len(self._index_cache) > self.index_cache_size:
+                self._index_cache.popitem(last=False)
         else:
-            filtered_df = self.patient_df
+            self._index_cache.move_to_end(key)
 
-        if filtered_df.empty:
+        if not len(rows):
             raise ValueError("No patients match the specified conditions")
 
-        return filtered_df.sample(n=1).iloc[0] 
\ No newline at end of file
+        return df.iloc[np.random.choice(rows)]
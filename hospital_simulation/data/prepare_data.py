@@ -9,10 +9,22 @@ from pathlib import Path
 import requests
 from PIL import Image
 from io import BytesIO
+import numpy as np
 import random
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
 from hospital_simulation.data.preprocess_data import DataPreprocessor
 from hospital_simulation.utils.env_loader import load_environment
 
+# Preprocessed X-ray pixels: one (N, 224, 224, 3) uint8 array, row i = train split row i
+XRAY_MEMMAP_PATH = Path(__file__).parent / "xrays.u8"
+XRAY_SIZE = 224
+
+def _save_image(pair: Tuple[Image.Image, Path]) -> Path:
+    img, img_path = pair
+    img.save(str(img_path), optimize=False)
+    return img_path
+
 def download_example_images():
     """Download example patient photos and X-rays."""
     example_images_dir = Path(__file__).parent / "example_images"
@@ -22,19 +34,68 @@ def download_example_images():
     print("\nDownloading example X-ray images...")
     try:
         from datasets import load_dataset
-        xray_dataset = load_dataset("keremberke/chest-xray-classification", name="full")
-        
-        # Save some example X-rays
-        for condition in ["NORMAL", "PNEUMONIA"]:
-            condition_images = [img for img in xray_dataset["train"] if img["label"] == condition]
-            for i, img_data in enumerate(random.sample(condition_images, 3)):
-                img = img_data["image"]
-                img_path = example_images_dir / f"xray_{condition.lower()}_{i+1}.jpg"
-                img.save(str(img_path))
+        xray_dataset = load_dataset(
+            "keremberke/chest-xray-classification", name="full", split="train", streaming=True
+        ).shuffle(seed=random.randrange(2**32), buffer_size=64)
+        label_names = xray_dataset.features["labels"].names
+        
+        # Stream until we have enough example X-rays per condition
+        per_condition = 3
+        selected = {"NORMAL": 0, "PNEUMONIA": 0}
+        pairs = []
+        for img_data in xray_dataset:
+            condition = label_names[img_data["labels"]]
+            if selected.get(condition, per_condition) >= per_condition:
+                continue
+            selected[condition] += 1
+            img_path = example_images_dir / f"xray_{condition.lower()}_{selected[condition]}.jpg"
+            pairs.append((img_data["image"], img_path))
+            if all(count >= per_condition for count in selected.values()):
+                break
+        
+        # Encode and write the images concurrently
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for img_path in executor.map(_save_image, pairs):
                 print(f"Saved {img_path.name}")
     except Exception as e:
         print(f"Error downloading X-ray images: {e}")
 
+def _resize_xray(image: dict) -> np.ndarray:
+    """Decode one encoded dataset image and resize it to XRAY_SIZE square RGB pixels."""
+    with Image.open(BytesIO(image["bytes"]) if image.get("bytes") else image["path"]) as img:
+        return np.asarray(img.convert("RGB").resize((XRAY_SIZE, XRAY_SIZE), Image.BILINEAR))
+
+def build_xray_memmap(batch_size: int = 64):
+    """Resize every training X-ray to a fixed size and store them as one memory-mapped array.
+
+    Images stay encoded until their batch is written, so peak memory is one batch.
+    """
+    print("\nBuilding X-ray memmap...")
+    try:
+        from datasets import load_dataset, Image as DatasetImage
+        # Same split and row order the interface indexes into
+        xray_dataset = load_dataset(
+            "keremberke/chest-xray-classification", name="full", split="train"
+        ).cast_column("image", DatasetImage(decode=False))
+        
+        # Write to a temporary file so a partial build is never picked up
+        tmp_path = XRAY_MEMMAP_PATH.with_suffix(".tmp")
+        pixels = np.memmap(
+            tmp_path, mode="w+", dtype=np.uint8,
+            shape=(len(xray_dataset), XRAY_SIZE, XRAY_SIZE, 3)
+        )
+        start = 0
+        for batch in xray_dataset.select_columns("image").iter(batch_size=batch_size):
+            images = batch["image"]
+            pixels[start:start + len(images)] = np.stack([_resize_xray(image) for image in images])
+            start += len(images)
+        pixels.flush()
+        del pixels
+        tmp_path.replace(XRAY_MEMMAP_PATH)
+        print(f"Saved {start} X-rays to {XRAY_MEMMAP_PATH.name}")
+    except Exception as e:
+        print(f"Error building X-ray memmap: {e}")
+
 def main():
     """Run data preparation."""
     print("Starting data preparation...")
@@ -53,6 +114,17 @@ def main():
         print("\nDownloading example images...")
         download_example_images()
         
+        # Preprocess the X-ray dataset for fast random access
+        build_xray_memmap()
+        
+        # Export the vision models so they run under ONNX Runtime
+        print("\nExporting vision models to ONNX...")
+        try:
+            from hospital_simulation.vision.patient_analysis import PatientImageAnalysis
+            PatientImageAnalysis.export_onnx_models()
+        except Exception as e:
+            print(f"Error exporting vision models, they will run in PyTorch: {e}")
+        
         print("\nData preparation completed successfully!")
         
     except Exception as e:
@@ -9,10 +9,14 @@ class DataPreprocessor(DataPreparation):
         super().__init__(model_name)
         self.output_dir = Path(__file__).parent / "processed"
         self.output_dir.mkdir(exist_ok=True)
-        self.preprocessed_file = self.output_dir / "preprocessed_patients.csv"
+        self.preprocessed_file = self.output_dir / "preprocessed_patients.parquet"
+        self._df_cache = None
 
-    def preprocess_and_save(self) -> pd.DataFrame:
-        """Run the complete preprocessing pipeline and save results."""
+    def preprocess_and_save(self, export_csv: bool = False) -> pd.DataFrame:
+        """Run the complete preprocessing pipeline and save results.
+
+        Results are stored as Parquet; set ``export_csv`` to also write a CSV copy for inspection.
+        """
         try:
             # Load and process medical dataset
             patient_df = self.prepare_medical_dataset()
@@ -27,9 +31,15 @@ class DataPreprocessor(DataPreparation):
             print(f"Final dataset contains {len(final_df)} records")
             
             # Save processed data
-            final_df.to_csv(self.preprocessed_file, index=False)
+            final_df = final_df.reset_index(drop=True)
+            final_df.to_parquet(self.preprocessed_file, engine='pyarrow', compression='zstd', index=False)
             print(f"\nSaved processed data to {self.preprocessed_file}")
+            if export_csv:
+                csv_file = self.preprocessed_file.with_suffix(".csv")
+                final_df.to_csv(csv_file, index=False)
+                print(f"Exported CSV copy to {csv_file}")
             
+            self._df_cache = final_df
             return final_df
             
         except Exception as e:
@@ -37,33 +47,23 @@ class DataPreprocessor(DataPreparation):
             raise
 
     def load_preprocessed_data(self) -> pd.DataFrame:
-        """Load preprocessed data if available, otherwise run preprocessing."""
+        """Load preprocessed data if available, otherwise run preprocessing.
+
+        The loaded frame is kept on the instance, so only the first call reads the file.
+        """
+        if self._df_cache is not None:
+            return self._df_cache
+        
         if not self.preprocessed_file.exists():
             print("Preprocessed data not found. Running preprocessing...")
             return self.preprocess_and_save()
         
         print(f"Loading preprocessed data from {self.preprocessed_file}")
-        return pd.read_csv(self.preprocessed_file)
-
-    def get_random_patient(self, conditions: dict = None) -> pd.Series:
-        """Get a random patient matching the specified conditions."""
-        df = self.load_preprocessed_data()
-        
-        if conditions:
-            mask = pd.Series(True, index=df.index)
-            for column, value in conditions.items():
-                if isinstance(value, tuple) and len(value) == 2:
-                    mask &= df[column].between(value[0], value[1])
-                else:
-                    mask &= df[column] == value
-            filtered_df = df[mask]
-        else:
-            filtered_df = df
-
-        if filtered_df.empty:
-            raise ValueError("No patients match the specified conditions")
+        self._df_cache = pd.read_parquet(self.preprocessed_file, engine='pyarrow')
+        return self._df_cache
 
-        return filtered_df.sample(n=1).iloc[0]
+    def _load_patients(self) -> pd.DataFrame:
+        return self.load_preprocessed_data()
 
 def main():
     """Run the preprocessing script."""
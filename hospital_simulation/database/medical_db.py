@@ -1,17 +1,35 @@
+import hashlib
 import json
+import os
+from itertools import islice
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, Iterable, Iterator, List
 
 import chromadb
+import diskcache
 from chromadb.config import Settings
 from langchain_community.embeddings import FastEmbedEmbeddings
 from langchain_community.vectorstores import Chroma
 
+def _batched(iterable: Iterable, size: int) -> Iterator[List]:
+    """Yield successive lists of up to size items from iterable."""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
 class MedicalDatabase:
+    collection_name = "medical"
+    batch_size = 512
+    embedding_batch_size = 256
+    # HNSW build parameters: lower construction_ef builds faster, M bounds graph memory
+    hnsw_settings = {"hnsw:construction_ef": 100, "hnsw:M": 16}
+
     def __init__(self, db_dir: str = "./data/chroma"):
         self.db_dir = Path(db_dir)
         self.db_dir.mkdir(parents=True, exist_ok=True)
-        self.embeddings = FastEmbedEmbeddings()
+        # Run ONNX inference on every core, in batches of embedding_batch_size texts
+        self.embeddings = FastEmbedEmbeddings(threads=os.cpu_count(), batch_size=self.embedding_batch_size)
+        self.embedding_cache = diskcache.Cache(str(self.db_dir / "embedding_cache"))
         self.vector_store = None
 
     def load_medical_data(self, data_path: str) -> List[Dict]:
@@ -19,23 +37,49 @@ class MedicalDatabase:
         with open(data_path, 'r') as f:
             return json.load(f)
 
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts, reusing cached vectors for texts seen before."""
+        keys = [
+            hashlib.blake2b(f"{self.embeddings.model_name}:{text}".encode(), digest_size=16).hexdigest()
+            for text in texts
+        ]
+        vectors = [self.embedding_cache.get(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            computed = self.embeddings.embed_documents([texts[i] for i in missing])
+            for i, vector in zip(missing, computed):
+                vectors[i] = vector
+                self.embedding_cache.set(keys[i], vector)
+        return vectors
+
     def initialize_vector_store(self, medical_data: List[Dict]):
-        """Initialize the vector store with medical data."""
-        texts = [str(record) for record in medical_data]
-        metadata = medical_data
-
-        self.vector_store = Chroma.from_texts(
-            texts=texts,
-            embedding=self.embeddings,
-            persist_directory=str(self.db_dir),
-            metadatas=metadata
+        """Initialize the vector store with medical data, embedding and indexing it in batches."""
+        client = chromadb.PersistentClient(path=str(self.db_dir))
+        collection = client.get_or_create_collection(
+            name=self.collection_name,
+            metadata=self.hnsw_settings
+        )
+
+        for start, records in zip(range(0, len(medical_data), self.batch_size),
+                                  _batched(medical_data, self.batch_size)):
+            texts = [str(record) for record in records]
+            collection.upsert(
+                ids=[str(i) for i in range(start, start + len(records))],
+                embeddings=self._embed_documents(texts),
+                documents=texts,
+                metadatas=records
+            )
+
+        self.vector_store = Chroma(
+            client=client,
+            collection_name=self.collection_name,
+            embedding_function=self.embeddings
         )
-        self.vector_store.persist()
 
     def search_similar_cases(self, query: str, k: int = 5) -> List[Dict]:
         """Search for similar medical cases."""
         if not self.vector_store:
             raise ValueError("Vector store not initialized. Call initialize_vector_store first.")
-        
+
         results = self.vector_store.similarity_search(query, k=k)
-        return [doc.metadata for doc in results] 
\ No newline at end of file
+        return [doc.metadata for doc in results]
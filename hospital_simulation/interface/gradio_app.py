@@ -1,70 +1,184 @@
+import asyncio
 import gradio as gr
 import json
-from typing import Dict, Any, Optional, Tuple
+import logging
+from typing import AsyncIterator, Dict, Any, List, Optional, Tuple
 from PIL import Image
 import numpy as np
 import random
 from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
+from collections import deque
+import queue
+import threading
+import time
 from io import BytesIO
-from datasets import load_dataset
+from datasets import load_dataset, Image as DatasetImage
 
-from hospital_simulation.agents.agent_graph import HospitalGraph
+from hospital_simulation.agents.agent_graph import get_graph
 from hospital_simulation.data.preprocess_data import DataPreprocessor
+from hospital_simulation.data.prepare_data import XRAY_MEMMAP_PATH, XRAY_SIZE
 from hospital_simulation.vision.patient_analysis import PatientImageAnalysis
 
+logger = logging.getLogger(__name__)
+
 class HospitalInterface:
+    # The prefetch thread gives up after this many failed downloads in a row
+    prefetch_max_failures = 8
+
     def __init__(self):
-        self.hospital = HospitalGraph()
+        self.hospital = get_graph()
         self.data_prep = DataPreprocessor()
         self.vision_analysis = PatientImageAnalysis()
+        # Model inference is shared across users; one at a time on a GPU to avoid OOM
+        self._vision_slots = asyncio.Semaphore(1 if self.vision_analysis.device.type == "cuda" else 2)
+        
+        # Keep-alive session for person photos, plus recent payloads to fall back on
+        self._http = requests.Session()
+        self._http.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+        self._recent_photos = deque(maxlen=32)
+        # Photos are downloaded ahead of time so generating one doesn't wait on the network
+        self._person_q: queue.Queue = queue.Queue(maxsize=10)
+        threading.Thread(target=self._prefetch_persons, name="person-prefetch", daemon=True).start()
         
         # Set up example images directory
         self.example_images_dir = Path(__file__).parent.parent / "data" / "example_images"
         self.example_images_dir.mkdir(exist_ok=True)
+        # Decode the example X-rays once; they only change when data is re-prepared
+        self._example_xrays = {
+            condition: self._load_example_images(f"xray_{prefix}_*.jpg")
+            for condition, prefix in (("Positive", "pneumonia"), ("Negative", "normal"))
+        }
         
         # Load X-ray dataset
         print("Loading X-ray dataset...")
-        self.x_ray_dataset = load_dataset("keremberke/chest-xray-classification", name="full")
+        # Only the train split is used; images stay encoded until a row is picked
+        self.x_ray_dataset = load_dataset(
+            "keremberke/chest-xray-classification", name="full", split="train"
+        ).cast_column("image", DatasetImage(decode=False))
+        
+        # Index rows by label once so picking an X-ray reads a single row
+        labels = np.asarray(self.x_ray_dataset["labels"])
+        self._xray_indices = {
+            name: np.flatnonzero(labels == label_id)
+            for label_id, name in enumerate(self.x_ray_dataset.features["labels"].names)
+        }
+        # Pixels preprocessed by prepare_data, if built; reading a row is then a page-cache lookup
+        self._xray_mm = self._load_xray_memmap(len(self.x_ray_dataset))
+        
+        # Patient columns that never count as symptoms
+        self._excluded_cols = ["Gender", "First_Name", "Last_Name", "Patient_ID", "Age", "Outcome Variable"]
         
         # Initialize interface
         self.interface = self._create_interface()
         self.current_patient = None
 
+    def _load_example_images(self, pattern: str) -> List[Image.Image]:
+        """Load and decode the example images matching a glob pattern."""
+        images = []
+        for path in sorted(self.example_images_dir.glob(pattern)):
+            try:
+                with Image.open(path) as img:
+                    img.load()
+                    images.append(img.copy())
+            except Exception as e:
+                print(f"Error loading example image {path.name}: {e}")
+        return images
+
+    @staticmethod
+    def _load_xray_memmap(expected_rows: int) -> Optional[np.memmap]:
+        """Map the preprocessed X-ray array read-only, or return None if it is missing or stale."""
+        if not XRAY_MEMMAP_PATH.exists():
+            return None
+        row_bytes = XRAY_SIZE * XRAY_SIZE * 3
+        rows, remainder = divmod(XRAY_MEMMAP_PATH.stat().st_size, row_bytes)
+        if remainder or rows != expected_rows:
+            print(f"Ignoring {XRAY_MEMMAP_PATH.name}: it does not match the dataset, re-run prepare_data")
+            return None
+        return np.memmap(XRAY_MEMMAP_PATH, mode="r", dtype=np.uint8, shape=(rows, XRAY_SIZE, XRAY_SIZE, 3))
+
+    def _decode_xray(self, index: int) -> Image.Image:
+        """Decode the X-ray image stored in one dataset row."""
+        if self._xray_mm is not None:
+            return Image.fromarray(self._xray_mm[index])
+        image = self.x_ray_dataset[index]["image"]
+        if image.get("bytes"):
+            return Image.open(BytesIO(image["bytes"]))
+        return Image.open(image["path"])
+
     def _get_random_xray(self, condition: str = None) -> Optional[Image.Image]:
         """Get a random X-ray image from the dataset."""
         try:
             if condition:
-                # Filter by condition
-                filtered_images = [
-                    img for img in self.x_ray_dataset["train"] 
-                    if img["disease"] == ("PNEUMONIA" if condition.upper() == "POSITIVE" else "NORMAL")
-                ]
-                if filtered_images:
-                    return random.choice(filtered_images)["image"]
+                # Pick from the precomputed rows for the condition
+                indices = self._xray_indices.get("PNEUMONIA" if condition.upper() == "POSITIVE" else "NORMAL")
+                if indices is not None and len(indices):
+                    return self._decode_xray(int(np.random.choice(indices)))
             
             # If no condition or no matching images, return random image
-            random_index = random.randint(0, len(self.x_ray_dataset["train"]) - 1)
-            return self.x_ray_dataset["train"][random_index]["image"]
+            random_index = random.randint(0, len(self.x_ray_dataset) - 1)
+            return self._decode_xray(random_index)
         except Exception as e:
             print(f"Error getting random X-ray: {e}")
-            print(f"Dataset structure: {self.x_ray_dataset['train'].features}")
+            print(f"Dataset structure: {self.x_ray_dataset.features}")
         return None
 
-    def _get_random_person_image(self, gender: str = None) -> Optional[Image.Image]:
-        """Fetch a random person image."""
+    def _download_person_image(self) -> Image.Image:
+        """Download a new random person image, raising if the request fails."""
+        # Using thispersondoesnotexist.com directly as it doesn't support parameters
+        response = self._http.get("https://thispersondoesnotexist.com/", timeout=10)
+        response.raise_for_status()
+        self._recent_photos.append(response.content)
+        return Image.open(BytesIO(response.content))
+
+    def _fetch_person_image(self) -> Optional[Image.Image]:
+        """Download a new random person image, or None if the fetch fails."""
         try:
-            # Using thispersondoesnotexist.com directly as it doesn't support parameters
-            response = requests.get("https://thispersondoesnotexist.com/", timeout=10)
-            if response.status_code == 200:
-                print("Successfully fetched random person image")
-                return Image.open(BytesIO(response.content))
-            else:
-                print(f"Failed to fetch image: {response.status_code}")
+            return self._download_person_image()
         except Exception as e:
             print(f"Error fetching random person image: {e}")
         return None
 
+    def _prefetch_persons(self):
+        """Keep the person photo pool topped up; put() blocks while it is full.
+
+        Failures back off exponentially (5s doubling up to 5 minutes), and the
+        thread stops after prefetch_max_failures in a row; photos are then
+        fetched on demand.
+        """
+        failures = 0
+        while failures < self.prefetch_max_failures:
+            try:
+                image = self._download_person_image()
+            except Exception as e:
+                failures += 1
+                # Only the first failure of a streak is a warning, so an outage doesn't flood the log
+                logger.log(logging.WARNING if failures == 1 else logging.DEBUG,
+                           "Person photo prefetch failed (%d in a row): %s", failures, e)
+                time.sleep(min(5 * 2 ** (failures - 1), 300))
+                continue
+            failures = 0
+            self._person_q.put(image)
+        logger.warning("Stopped person photo prefetch after %d consecutive failures", failures)
+
+    def _get_random_person_image(self, gender: str = None) -> Optional[Image.Image]:
+        """Fetch a random person image."""
+        try:
+            image = self._person_q.get_nowait()
+            print("Using prefetched person image")
+            return image
+        except queue.Empty:
+            pass
+        image = self._fetch_person_image()
+        if image is not None:
+            print("Successfully fetched random person image")
+            return image
+        if self._recent_photos:
+            print("Using a previously fetched person image")
+            return Image.open(BytesIO(random.choice(self._recent_photos)))
+        return None
+
     def _format_output(self, result: Dict[str, Any]) -> str:
         """Format the output for display."""
         output = []
@@ -121,13 +235,12 @@ class HospitalInterface:
             print(f"Loading patient with conditions: {conditions}")
             patient = self.data_prep.get_random_patient(conditions)
             
+            # Pull the identity fields out in one lookup and work on a plain dict
+            core = patient[["First_Name", "Last_Name", "Patient_ID", "Age", "Gender"]].to_dict()
+            
             # Create a dictionary with patient data including ethnicity
             self.current_patient = {
-                "First_Name": patient["First_Name"],
-                "Last_Name": patient["Last_Name"],
-                "Patient_ID": patient["Patient_ID"],
-                "Age": patient["Age"],
-                "Gender": patient["Gender"],
+                **core,
                 "ethnicity": ethnicity  # Store the selected ethnicity
             }
             
@@ -135,31 +248,20 @@ class HospitalInterface:
             patient_photo = None
             xray_image = None
             
-            # Try to get matching example images
-            try:
-                if condition == "Positive":
-                    xray_files = list(self.example_images_dir.glob("xray_pneumonia_*.jpg"))
-                    if xray_files:
-                        xray_image = str(random.choice(xray_files))
-                        print(f"Loaded pneumonia X-ray: {xray_image}")
-                elif condition == "Negative":
-                    xray_files = list(self.example_images_dir.glob("xray_normal_*.jpg"))
-                    if xray_files:
-                        xray_image = str(random.choice(xray_files))
-                        print(f"Loaded normal X-ray: {xray_image}")
-            except Exception as e:
-                print(f"Error loading example images: {e}")
+            # Use a matching example image if available
+            example_xrays = self._example_xrays.get(condition)
+            if example_xrays:
+                xray_image = random.choice(example_xrays)
+                print(f"Loaded {'pneumonia' if condition == 'Positive' else 'normal'} X-ray example")
 
             # Return values in the order expected by Gradio outputs
-            name = f"{patient['First_Name']} {patient['Last_Name']}"
-            patient_id = patient["Patient_ID"]
-            age = str(patient["Age"])
-            gender = patient["Gender"]
-            symptoms = ", ".join([
-                col for col in patient.index 
-                if patient[col] == "Yes" and col not in 
-                ["Gender", "First_Name", "Last_Name", "Patient_ID", "Age", "Outcome Variable"]
-            ])
+            name = f"{core['First_Name']} {core['Last_Name']}"
+            patient_id = core["Patient_ID"]
+            age = str(core["Age"])
+            gender = core["Gender"]
+            # Vectorized over the row; isin keeps the columns in dataset order
+            symptom_mask = (patient == "Yes") & ~patient.index.isin(self._excluded_cols)
+            symptoms = ", ".join(patient.index[symptom_mask])
 
             print(f"Loaded patient: {name} (ID: {patient_id})")
             print(f"Symptoms: {symptoms}")
@@ -167,12 +269,13 @@ class HospitalInterface:
             
             return name, patient_id, age, gender, ethnicity, symptoms, patient_photo, xray_image
 
-        def process_patient(name: str, patient_id: str, age: str, gender: str, ethnicity: str, symptoms: str,
-                          patient_photo: Optional[Image.Image] = None,
-                          xray_image: Optional[Image.Image] = None) -> Tuple[str, Dict, Dict, str]:
-            """Process patient information and return results."""
+        async def process_patient(name: str, patient_id: str, age: str, gender: str, ethnicity: str, symptoms: str,
+                                  patient_photo: Optional[Image.Image] = None,
+                                  xray_image: Optional[Image.Image] = None) -> AsyncIterator[Tuple[str, Dict, Dict, str]]:
+            """Process patient information, yielding results as each stage finishes."""
             if not all([name, patient_id, age, gender, ethnicity, symptoms]):
-                return "Error: Please load a patient first", {}, {}, "No logs available - patient not processed"
+                yield "Error: Please load a patient first", {}, {}, "No logs available - patient not processed"
+                return
 
             # Prepare patient info
             patient_info = {
@@ -183,41 +286,72 @@ class HospitalInterface:
                 "ethnicity": ethnicity
             }
 
+            outputs = {
+                "assessment": "Processing patient...",
+                "photo": {},
+                "xray": {},
+                "logs": "Processing patient..."
+            }
+            events: asyncio.Queue = asyncio.Queue()
+
+            async def run_vision(key: str, label: str, analyze, image: Optional[Image.Image]):
+                try:
+                    if image is not None:
+                        print(f"Analyzing {label}...")
+                        async with self._vision_slots:
+                            result = await asyncio.to_thread(analyze, image)
+                        print(f"{label[0].upper()}{label[1:]} analysis results:", result)
+                        await events.put((key, result))
+                except Exception as e:
+                    await events.put(("error", e))
+                finally:
+                    await events.put(None)
+
+            async def run_workflow():
+                try:
+                    print("Processing through hospital workflow...")
+                    async for result in self.hospital.stream_patient(
+                        patient_info=patient_info,
+                        complaint=symptoms,
+                        medical_records=""
+                    ):
+                        await events.put(("workflow", result))
+                except Exception as e:
+                    await events.put(("error", e))
+                finally:
+                    await events.put(None)
+
+            # The vision analyses and the agent workflow don't depend on each
+            # other, so all three run at once and report as they progress
+            tasks = [
+                asyncio.create_task(run_vision("photo", "patient photo", self.vision_analysis.analyze_patient_photo, patient_photo)),
+                asyncio.create_task(run_vision("xray", "X-ray image", self.vision_analysis.analyze_xray, xray_image)),
+                asyncio.create_task(run_workflow())
+            ]
+            yield outputs["assessment"], outputs["photo"], outputs["xray"], outputs["logs"]
+
             try:
-                # Analyze patient photo if provided
-                photo_analysis = {}
-                if patient_photo is not None:
-                    print("Analyzing patient photo...")
-                    photo_analysis = self.vision_analysis.analyze_patient_photo(patient_photo)
-                    print("Photo analysis results:", photo_analysis)
-
-                # Analyze X-ray if provided
-                xray_analysis = {}
-                if xray_image is not None:
-                    print("Analyzing X-ray image...")
-                    xray_analysis = self.vision_analysis.analyze_xray(xray_image)
-                    print("X-ray analysis results:", xray_analysis)
-
-                # Process through hospital workflow
-                print("Processing through hospital workflow...")
-                result = self.hospital.process_patient(
-                    patient_info=patient_info,
-                    complaint=symptoms,
-                    medical_records=""
-                )
-                
-                # Return formatted outputs
-                return (
-                    result.get("formatted_assessment", "Error: No assessment available"),
-                    photo_analysis,
-                    xray_analysis,
-                    result.get("formatted_logs", "Error: No logs available")
-                )
-                
-            except Exception as e:
-                error_msg = f"Error processing patient: {str(e)}"
-                print(error_msg)
-                return error_msg, photo_analysis, xray_analysis, f"Error in processing: {str(e)}"
+                running = len(tasks)
+                while running:
+                    event = await events.get()
+                    if event is None:
+                        running -= 1
+                        continue
+                    kind, value = event
+                    if kind == "workflow":
+                        outputs["assessment"] = value.get("formatted_assessment", "Error: No assessment available")
+                        outputs["logs"] = value.get("formatted_logs", "Error: No logs available")
+                    elif kind == "error":
+                        error_msg = f"Error processing patient: {str(value)}"
+                        print(error_msg)
+                        outputs["assessment"] = error_msg
+                        outputs["logs"] = f"Error in processing: {str(value)}"
+                    else:
+                        outputs[kind] = value
+                    yield outputs["assessment"], outputs["photo"], outputs["xray"], outputs["logs"]
+            finally:
+                for task in tasks:
+                    task.cancel()
 
         def generate_person_photo(gender: str, ethnicity: str) -> Optional[Image.Image]:
             """Generate a random person photo based on gender and ethnicity."""
@@ -323,19 +457,22 @@ class HospitalInterface:
             load_btn.click(
                 load_random_patient,
                 inputs=[age_min, age_max, gender, ethnicity, condition],
-                outputs=[name, patient_id, age, gender_display, ethnicity_display, symptoms, patient_photo, xray_image]
+                outputs=[name, patient_id, age, gender_display, ethnicity_display, symptoms, patient_photo, xray_image],
+                concurrency_limit=4
             )
 
             generate_photo_btn.click(
                 generate_person_photo,
                 inputs=[gender_display, ethnicity_display],
-                outputs=[patient_photo]
+                outputs=[patient_photo],
+                concurrency_limit=4
             )
 
             generate_xray_btn.click(
                 generate_xray,
                 inputs=[condition],
-                outputs=[xray_image]
+                outputs=[xray_image],
+                concurrency_limit=4
             )
 
             process_btn.click(
@@ -397,6 +534,8 @@ class HospitalInterface:
             </style>
             """)
 
+        # Queue requests so users are served concurrently instead of one at a time
+        blocks.queue(default_concurrency_limit=8, max_size=64)
         return blocks
 
     def launch(self, **kwargs):
@@ -1,33 +1,34 @@
 from dotenv import load_dotenv
+from functools import lru_cache
 import os
 from pathlib import Path
 
+# The project root (where .env should be located) is three levels up from this file
+ENV_PATH = Path(__file__).resolve().parent.parent.parent / '.env'
+
+@lru_cache(maxsize=1)
 def load_environment():
-    """Load environment variables from .env file."""
-    # Find the project root (where .env should be located)
-    current_dir = Path(__file__).resolve()
-    project_root = current_dir.parent.parent.parent  # Go up three levels to project root
-    env_path = project_root / '.env'
+    """Load environment variables from .env file.
 
-    if not env_path.exists():
+    Only the first call does any work; later calls return immediately.
+    """
+    # load_dotenv reports whether it found and loaded anything, saving a separate exists() check
+    if not load_dotenv(ENV_PATH, override=False):
         raise EnvironmentError(
-            f"No .env file found at {env_path}. Please create one with your GROQ_API_KEY. "
+            f"No .env file found at {ENV_PATH} (or it is empty). Please create one with your GROQ_API_KEY. "
             "Example: GROQ_API_KEY=your-api-key-here"
         )
 
-    # Load the environment variables
-    load_dotenv(env_path)
-
     # Verify required variables
     required_vars = ['GROQ_API_KEY']
     missing_vars = [var for var in required_vars if not os.getenv(var)]
-    
+
     if missing_vars:
         raise EnvironmentError(
             f"Missing required environment variables: {', '.join(missing_vars)}. "
-            f"Please add them to your .env file at {env_path}"
+            f"Please add them to your .env file at {ENV_PATH}"
         )
-    
+
     # Print confirmation
-    print(f"Loaded environment variables from {env_path}")
-    print(f"GROQ_API_KEY is {'set' if os.getenv('GROQ_API_KEY') else 'not set'}") 
\ No newline at end of file
+    print(f"Loaded environment variables from {ENV_PATH}")
+    print(f"GROQ_API_KEY is {'set' if os.getenv('GROQ_API_KEY') else 'not set'}")
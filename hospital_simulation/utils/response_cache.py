@@ -0,0 +1,67 @@
+import hashlib
+import re
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+class ResponseCache:
+    """Cache for LLM responses backed by SQLite.
+
+    Responses are keyed by a SHA256 of the normalized prompt, so only an
+    identical prompt (up to case and whitespace) reuses a response.
+    """
+
+    _instance: Optional["ResponseCache"] = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, db_path: str = "./data/llm_cache.db"):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, llm_key TEXT NOT NULL, response TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    @classmethod
+    def get_instance(cls) -> "ResponseCache":
+        """Return the process-wide cache, creating it on first use."""
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    @staticmethod
+    def normalize(prompt: str) -> str:
+        """Lowercase the prompt and collapse whitespace."""
+        return _WHITESPACE_RE.sub(" ", prompt.lower()).strip()
+
+    @staticmethod
+    def _key(normalized_prompt: str, llm_key: str) -> str:
+        return hashlib.sha256(f"{llm_key}:{normalized_prompt}".encode()).hexdigest()
+
+    def lookup(self, prompt: str, llm_key: str) -> Optional[str]:
+        """Return a cached response for the prompt, or None on a miss."""
+        key = self._key(self.normalize(prompt), llm_key)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def update(self, prompt: str, llm_key: str, response: str):
+        """Store a response for the prompt."""
+        key = self._key(self.normalize(prompt), llm_key)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, llm_key, response) VALUES (?, ?, ?)",
+                (key, llm_key, response)
+            )
+            self._conn.commit()